@@ -2,20 +2,70 @@
 
 import os
 import io
-import json
+import asyncio
+import re
+import time
+import queue
+import struct
+import copy
+import hashlib
+import functools
+import atexit
 import logging
+import logging.handlers
+import threading
 import traceback
-from pathlib import Path
-from flask import Flask, request, jsonify, send_file
-from flask_cors import CORS
+from collections import OrderedDict
+from typing import Optional
+import uvicorn
+import orjson
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
+import numpy as np
+import soundfile as sf
+import torch
+from kokoro import KModel, KPipeline
 
-# Setup logging
-logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Optional encoders for formats libsndfile can't produce
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    import pydub
+except ImportError:
+    pydub = None
+
+# Optional, only needed for int8 quantization on GPU
+try:
+    import bitsandbytes as bnb
+except ImportError:
+    bnb = None
+
+# Setup logging. Records are written out by a listener thread, so request
+# threads only enqueue them instead of blocking on stderr.
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_queue = queue.Queue()
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))  # The listener's handler adds the rest
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)
+class OrjsonResponse(JSONResponse):
+    """JSON response serialized with orjson."""
+    
+    def render(self, content):
+        return orjson.dumps(content)
+
+app = FastAPI(default_response_class=OrjsonResponse)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
 # Server config
 HOST = "0.0.0.0"
@@ -25,11 +75,80 @@ PORT = 8013
 MODEL_ID = "hexgrad/Kokoro-82M"
 DEFAULT_LANG_CODE = 'a'  # American English
 DEFAULT_VOICE = "af_heart"
-SUPPORTED_FORMATS = ["mp3", "opus", "aac", "flac", "wav", "pcm"]  # Added PCM format
+AUDIO_FORMATS = ("mp3", "opus", "aac", "flac", "wav", "pcm")  # Added PCM format
+SAMPLE_RATE = 24000  # Kokoro always generates 24 kHz audio
+
+# Formats libsndfile can encode directly, as (format, subtype). MP3 and Opus
+# need libsndfile >= 1.1, which the soundfile wheels bundle.
+SOUNDFILE_FORMATS = {"wav": ("WAV", None), "flac": ("FLAC", None)}
+if "MP3" in sf.available_formats():
+    SOUNDFILE_FORMATS["mp3"] = ("MP3", None)
+if "OGG" in sf.available_formats() and "OPUS" in sf.available_subtypes("OGG"):
+    SOUNDFILE_FORMATS["opus"] = ("OGG", "OPUS")
+
+# Formats PyAV can encode, as (container, codec). FLAC is left to libsndfile:
+# muxed into a non-seekable stream its STREAMINFO never gets the sample count.
+AV_FORMATS = {
+    "mp3": ("mp3", "libmp3lame"),
+    "opus": ("ogg", "libopus"),
+    "aac": ("adts", "aac"),
+} if av else {}
+
+# Formats whose complete file from libsndfile beats PyAV's streamed output.
+# Streamed MP3 has no Xing/LAME header, so decoders play the encoder padding.
+SOUNDFILE_PREFERRED = frozenset({"mp3", "flac"})
+
+# Precision used for inference on GPU: "fp32", or "fp16"/"bf16" to run under
+# autocast. Reduced precision is dropped again if it fails the canary check.
+PRECISION = os.getenv("KOKORO_PRECISION", "fp32").lower()
+autocast_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(PRECISION)
+
+# torch.compile mode for the Kokoro model (e.g. "reduce-overhead"); unset to run eagerly
+COMPILE_MODE = os.getenv("KOKORO_COMPILE_MODE")
+# Quantize linear layers to int8 (bitsandbytes on GPU, dynamic quantization on CPU)
+QUANTIZE_INT8 = os.getenv("KOKORO_INT8", "0") == "1"
+# Synthesized to check a quantized model still produces usable audio
+CANARY_TEXT = "The quick brown fox jumps over the lazy dog."
+# Synthesized at load time when compiling so the first request doesn't pay for it
+WARMUP_TEXTS = ["Warming up.", "This is a slightly longer sentence, used to warm up another input length."]
 
-# Global variable for the TTS pipeline
-tts_pipeline = None
-supported_voices = None
+# Inputs are split at sentence boundaries into pieces of at most this many
+# characters (a single longer sentence is kept whole). The whitespace after
+# Latin punctuation is captured so pieces keep it; CJK punctuation has none.
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])(\s+)|(?<=[。！？])')
+MAX_PIECE_CHARS = 400
+
+# Samples converted per pass when producing int16 PCM; small enough that the
+# float scratch buffer stays in cache
+PCM_BLOCK_SIZE = 1 << 16
+
+# Dynamic batching config
+BATCH_MAX_SIZE = 8  # Max number of requests forwarded to the pipeline at once
+BATCH_TIMEOUT_MS = 20  # How long to wait for more requests before running a batch
+
+# Admission control. Requests hold a slot from queueing until their synthesis
+# finishes, even if the response is still streaming; the default lets a full
+# batch form.
+MAX_CONCURRENCY = int(os.getenv("KOKORO_MAX_CONCURRENCY", str(BATCH_MAX_SIZE)))
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("KOKORO_QUEUE_TIMEOUT", "30"))
+RETRY_AFTER_SECONDS = 5
+
+# Audio cache config
+CACHE_MAX_ENTRIES = 1024
+CACHE_MAX_BYTES = 256 * 1024 * 1024  # Total size of cached audio; one long wav/pcm entry is several MB
+CACHE_TTL_SECONDS = 86400
+CACHE_MAX_TEXT_LENGTH = 2000  # Longer inputs are never cached
+
+# Loaded pipelines by language, least recently used first. They all share
+# one KModel, so evicting a pipeline only drops its G2P.
+MAX_PIPELINES = 2
+pipelines = OrderedDict()
+pipeline_lock = threading.RLock()
+tts_model = None
+# Voice packs by name, shared by every pipeline, and the names that failed
+# to load so they aren't downloaded again on every pipeline load
+voice_cache = {}
+unavailable_voices = set()
 supported_langs = {
     'a': 'American English',
     'b': 'British English',
@@ -42,6 +161,7 @@ supported_langs = {
     'z': 'Mandarin Chinese'
 }
 
+@functools.lru_cache(maxsize=None)
 def get_supported_voices(lang_code=DEFAULT_LANG_CODE):
     """Get the voices supported by Kokoro for the given language."""
     try:
@@ -58,12 +178,12 @@ def get_supported_voices(lang_code=DEFAULT_LANG_CODE):
             # For other languages, return a common subset that generally works
             voices = ["en_female_1", "en_male_1", "en_female_2", "en_male_2"]
         
-        logger.info(f"Using known voices for language '{lang_code}': {voices}")
-        return voices
+        logger.info("Using known voices for language '%s': %s", lang_code, voices)
+        return frozenset(voices)
     except Exception as e:
-        logger.error(f"Error getting supported voices: {e}")
+        logger.error("Error getting supported voices: %s", e)
         # Return default voice list as fallback
-        return [
+        return frozenset([
             "af_heart", "af_alloy", "af_aoede", "af_bella", "af_jessica", "af_kore", "af_nicole",
             "af_nova", "af_river", "af_sarah", "af_sky", "am_adam", "am_echo", "am_eric",
             "am_fenrir", "am_liam", "am_michael", "am_onyx", "am_puck", "am_santa",
@@ -73,165 +193,697 @@ def get_supported_voices(lang_code=DEFAULT_LANG_CODE):
             "zm_yunxia", "zm_yunyang", "ef_dora", "em_alex", "em_santa", "ff_siwis",
             "hf_alpha", "hf_beta", "hm_omega", "hm_psi", "if_sara", "im_nicola",
             "pf_dora", "pm_alex", "pm_santa"
-        ]
+        ])
+
+def run_pipeline(pipeline, texts, voice=DEFAULT_VOICE, speed=1.0):
+    """Run texts through a pipeline, yielding its results."""
+    # The pipeline is lazy, so the whole iteration has to run under these
+    # contexts; autocast only applies on GPU, where it enables tensor cores
+    use_autocast = autocast_dtype is not None and torch.cuda.is_available()
+    with torch.inference_mode(), torch.autocast('cuda', dtype=autocast_dtype, enabled=use_autocast):
+        yield from pipeline(texts, voice=voice, speed=speed)
+
+def preload_voices(pipeline, lang_code):
+    """Load the voice packs of a language into voice_cache, warning once about any that can't be loaded."""
+    for voice in sorted(get_supported_voices(lang_code)):
+        if voice in voice_cache or voice in unavailable_voices:
+            continue
+        try:
+            voice_cache[voice] = pipeline.load_voice(voice)
+        except Exception as e:
+            unavailable_voices.add(voice)
+            logger.warning("Could not load voice '%s': %s", voice, e)
+
+def replace_linear_int8(module):
+    """Replace the nn.Linear layers under module with bitsandbytes int8 layers, in place."""
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear):
+            int8_linear = bnb.nn.Linear8bitLt(child.in_features, child.out_features, bias=child.bias is not None,
+                                              has_fp16_weights=False, threshold=6.0)
+            int8_linear.weight = bnb.nn.Int8Params(child.weight.data.cpu(), requires_grad=False, has_fp16_weights=False)
+            if child.bias is not None:
+                int8_linear.bias = torch.nn.Parameter(child.bias.data.cpu(), requires_grad=False)
+            # Weights are quantized when moved to the GPU
+            setattr(module, name, int8_linear.to(child.weight.device))
+        else:
+            replace_linear_int8(child)
+    return module
+
+def passes_canary(pipeline):
+    """Synthesize a short utterance and check the audio is finite and not silent."""
+    segments = [to_numpy(result.audio) for result in run_pipeline(pipeline, [CANARY_TEXT])]
+    if not segments:
+        return False
+    samples = np.concatenate(segments)
+    return bool(samples.size and np.isfinite(samples).all() and np.abs(samples).max() > 1e-3)
+
+def check_precision(pipeline):
+    """Fall back to fp32 if the model doesn't produce usable audio under autocast."""
+    global autocast_dtype
+    
+    try:
+        usable = passes_canary(pipeline)
+    except Exception as e:
+        logger.warning("Canary utterance failed under %s autocast: %s", PRECISION, e)
+        usable = False
+    
+    if not usable:
+        logger.warning("%s autocast produced invalid audio, falling back to fp32", PRECISION)
+        autocast_dtype = None
+
+def quantize_model(pipeline):
+    """Swap the shared model for an int8 version, keeping full precision if it fails the canary check.
+    
+    Linear layers are quantized with bitsandbytes on GPU and with PyTorch
+    dynamic quantization on CPU; norms, embeddings and convolutions are left alone.
+    """
+    global tts_model
+    
+    original = pipeline.model
+    try:
+        if original.device.type == 'cuda':
+            if bnb is None:
+                logger.warning("KOKORO_INT8 is set but bitsandbytes is not installed, keeping full precision model")
+                return
+            quantized = replace_linear_int8(copy.deepcopy(original))
+        else:
+            quantized = torch.ao.quantization.quantize_dynamic(original, {torch.nn.Linear}, dtype=torch.qint8)
+        
+        pipeline.model = quantized
+        if not passes_canary(pipeline):
+            raise ValueError("canary utterance produced invalid audio")
+    except Exception as e:
+        logger.warning("Int8 quantization failed, keeping full precision model: %s", e)
+        pipeline.model = original
+        return
+    
+    tts_model = quantized
+    logger.info("Quantized model linear layers to int8")
 
 def load_pipeline(lang_code=DEFAULT_LANG_CODE):
-    """Load the Kokoro TTS pipeline."""
-    global tts_pipeline, supported_voices
+    """Load the Kokoro TTS pipeline for a language, reusing the shared model if already loaded."""
+    global tts_model
     
-    logger.info(f"Loading Kokoro TTS pipeline with language '{lang_code}'...")
+    logger.info("Loading Kokoro TTS pipeline with language '%s'...", lang_code)
     
     try:
-        from kokoro import KPipeline
+        new_model = tts_model is None
+        if new_model:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            tts_model = KModel(repo_id=MODEL_ID).to(device).eval()
+            
+            # Check if GPU is being used
+            if torch.cuda.is_available():
+                logger.info("Using GPU acceleration! (precision: %s)", PRECISION)
+            else:
+                logger.warning("GPU not available, using CPU instead")
         
-        # Initialize the pipeline with the appropriate language
-        tts_pipeline = KPipeline(lang_code=lang_code)
+        # Initialize the pipeline with the appropriate language on top of the shared model
+        pipeline = KPipeline(lang_code=lang_code, repo_id=MODEL_ID, model=False)
+        pipeline.model = tts_model
         
-        # Get supported voices
-        supported_voices = get_supported_voices(lang_code)
+        preload_voices(pipeline, lang_code)
         
-        # Check if GPU is being used
-        import torch
-        if torch.cuda.is_available():
-            logger.info("Using GPU acceleration!")
-        else:
-            logger.warning("GPU not available, using CPU instead")
+        if new_model and autocast_dtype is not None and torch.cuda.is_available():
+            check_precision(pipeline)
+        
+        if new_model and QUANTIZE_INT8:
+            quantize_model(pipeline)
+        
+        if new_model and COMPILE_MODE:
+            logger.info("Compiling Kokoro model (mode: %s)...", COMPILE_MODE)
+            # KModel.forward takes the phoneme string, which would make every new
+            # utterance a recompile. Compile the tensor path it delegates to instead,
+            # with dynamic shapes so differing token counts share one graph.
+            tts_model.forward_with_tokens = torch.compile(
+                tts_model.forward_with_tokens, mode=COMPILE_MODE, dynamic=True
+            )
+            
+            # Compilation happens lazily on the first calls, so get it out of the way now
+            for _ in run_pipeline(pipeline, WARMUP_TEXTS):
+                pass
             
         logger.info("TTS pipeline loaded successfully!")
+        return pipeline
         
     except Exception as e:
-        logger.error(f"Error loading TTS pipeline: {e}")
+        logger.error("Error loading TTS pipeline: %s", e)
         raise
 
-def generate_speech(text, voice=DEFAULT_VOICE, lang_code=DEFAULT_LANG_CODE, response_format="mp3", speed=1.0):
-    """Generate speech from text using the Kokoro pipeline."""
-    global tts_pipeline, supported_voices
+def get_pipeline(lang_code=DEFAULT_LANG_CODE):
+    """Return the pipeline for a language, loading it on first use."""
+    with pipeline_lock:
+        pipeline = pipelines.get(lang_code)
+        if pipeline is not None:
+            pipelines.move_to_end(lang_code)
+            return pipeline
+        
+        pipeline = load_pipeline(lang_code)
+        pipelines[lang_code] = pipeline
+        while len(pipelines) > MAX_PIPELINES:
+            evicted, _ = pipelines.popitem(last=False)
+            logger.info("Evicted pipeline for language '%s'", evicted)
+        return pipeline
+
+def split_text(text, max_chars=MAX_PIECE_CHARS):
+    """Split text into pieces of whole sentences, up to max_chars long where possible.
     
-    if tts_pipeline is None:
-        load_pipeline(lang_code)
+    KPipeline runs G2P over a whole piece before producing any audio from it,
+    so sentence-sized pieces let the first audio come out sooner on long inputs.
+    """
+    pieces = []
+    for paragraph in re.split(r'\n+', text.strip()):
+        # Sentences sit at even indices, the separator that followed each one
+        # (None after CJK punctuation) at odd indices
+        parts = SENTENCE_BOUNDARY.split(paragraph)
+        current = ""
+        separator = ""
+        for i in range(0, len(parts), 2):
+            sentence = parts[i].strip()
+            if sentence:
+                if current and len(current) + len(separator) + len(sentence) > max_chars:
+                    pieces.append(current)
+                    current = sentence
+                else:
+                    current = current + separator + sentence if current else sentence
+            separator = parts[i + 1] or "" if i + 1 < len(parts) else ""
+        if current:
+            pieces.append(current)
+    return pieces
+
+def synthesize(text, voice=DEFAULT_VOICE, lang_code=DEFAULT_LANG_CODE, speed=1.0):
+    """Run one text through the pipeline, yielding audio per segment."""
+    pipeline = get_pipeline(lang_code)
     
-    try:
-        import soundfile as sf
-        
-        # Generate speech using the pipeline
-        generator = tts_pipeline(
-            text, 
-            voice=voice, 
-            speed=speed
-        )
+    # Pass the preloaded voice pack when there is one; KPipeline accepts
+    # either a voice name or the tensor itself
+    voice_pack = voice_cache.get(voice, voice)
+    
+    for result in run_pipeline(pipeline, split_text(text), voice=voice_pack, speed=speed):
+        yield result.audio
+
+class SegmentStream:
+    """Audio segments of one request, filled in by the batcher thread as they are synthesized.
+    
+    `on_done` is called from the batcher thread once synthesis has finished or
+    failed, regardless of how far the consumer has read.
+    """
+    
+    _END = object()
+    
+    def __init__(self, on_done=None):
+        self._queue = queue.Queue()
+        self._on_done = on_done
+    
+    def put(self, segment):
+        self._queue.put(segment)
+    
+    def close(self):
+        self._queue.put(self._END)
+        self._done()
+    
+    def fail(self, error):
+        self._queue.put(error)
+        self._done()
+    
+    def _done(self):
+        if self._on_done is not None:
+            self._on_done()
+    
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+class SpeechBatcher:
+    """Groups concurrent synthesis requests that share a pipeline and voice.
+    
+    Requests with the same (lang_code, voice, speed) that arrive within
+    `timeout_ms` of each other are synthesized back to back by a single worker
+    thread, which also keeps the GPU to one caller at a time. KPipeline works
+    through its inputs one at a time anyway, so each request gets its own
+    pipeline call and a failing text only fails its own request.
+    """
+    
+    def __init__(self, max_batch_size=BATCH_MAX_SIZE, timeout_ms=BATCH_TIMEOUT_MS):
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout_ms / 1000.0
+        self._pending = []
+        self._cond = threading.Condition()
+        self._worker = None
+    
+    def submit(self, text, voice, lang_code, speed, on_done=None):
+        """Queue text for synthesis, returning a SegmentStream of its audio segments."""
+        stream = SegmentStream(on_done)
+        with self._cond:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="tts-batcher", daemon=True)
+                self._worker.start()
+            self._pending.append(((lang_code, voice, speed), text, stream))
+            self._cond.notify()
+        return stream
+    
+    def _next_batch(self):
+        """Block until a batch is ready and remove it from the pending queue."""
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            
+            # Batch around the oldest request so no key can be starved
+            key = self._pending[0][0]
+            deadline = time.monotonic() + self.timeout
+            while True:
+                batch = [item for item in self._pending if item[0] == key][:self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            
+            taken = {id(item) for item in batch}
+            self._pending = [item for item in self._pending if id(item) not in taken]
         
-        # Collect all audio segments
-        audio_segments = []
-        for i, (graphemes, phonemes, audio) in enumerate(generator):
-            audio_segments.append(audio)
+        return key, batch
+    
+    def _run(self):
+        while True:
+            (lang_code, voice, speed), batch = self._next_batch()
+            logger.info("Running batch of %d request(s) for voice '%s' (lang '%s', speed %s)", len(batch), voice, lang_code, speed)
+            
+            for _, text, stream in batch:
+                # Segments are handed over as soon as they are produced so
+                # requests can start streaming before the whole batch is done
+                try:
+                    for audio in synthesize(text, voice=voice, lang_code=lang_code, speed=speed):
+                        stream.put(audio)
+                except Exception as e:
+                    logger.error("Error synthesizing speech: %s", e)
+                    logger.error(traceback.format_exc())
+                    stream.fail(e)
+                    continue
+                
+                stream.close()
+
+speech_batcher = SpeechBatcher()
+
+def to_numpy(audio):
+    """Return audio as a NumPy array, copying PyTorch tensors to the CPU if needed.
+    
+    KModel already moves its output to the CPU, so for Kokoro's own pipeline
+    this is a zero-copy view rather than a device-to-host transfer.
+    """
+    if isinstance(audio, torch.Tensor):
+        return audio.cpu().numpy()
+    return audio
+
+def join_segments(audio_segments):
+    """Copy audio segments into a single preallocated array.
+    
+    Each segment is dropped from the list once copied so it can be freed right
+    away, rather than every segment living alongside the combined buffer.
+    """
+    total = sum(segment.shape[0] for segment in audio_segments)
+    combined = np.empty(total, dtype=np.float32)
+    
+    offset = 0
+    for i, segment in enumerate(audio_segments):
+        audio_segments[i] = None
+        segment = to_numpy(segment)
+        combined[offset:offset + segment.shape[0]] = segment
+        offset += segment.shape[0]
+    
+    return combined
+
+# Bounds the number of requests being synthesized; acquired by the endpoint on
+# the event loop, so waiting requests don't occupy executor threads
+request_slots = asyncio.Semaphore(MAX_CONCURRENCY)
+
+class RequestSlot:
+    """A held request_slots permit that can be released once, from any thread.
+    
+    Once its request has been handed to the batcher, only the end of synthesis
+    releases it; abandoning the request (e.g. on client disconnect) no longer does.
+    """
+    
+    def __init__(self, loop):
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._released = False
+        self._handed_off = False
+    
+    def hand_off(self):
+        """Mark the request as submitted for synthesis; False if the slot was already given up."""
+        with self._lock:
+            if self._released:
+                return False
+            self._handed_off = True
+            return True
+    
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._loop.call_soon_threadsafe(request_slots.release)
+    
+    def abandon(self):
+        """Release the slot unless its request already reached the batcher."""
+        with self._lock:
+            if self._handed_off or self._released:
+                return
+            self._released = True
+        self._loop.call_soon_threadsafe(request_slots.release)
+
+def generate_speech(text, voice=DEFAULT_VOICE, lang_code=DEFAULT_LANG_CODE, response_format="mp3", speed=1.0, slot=None):
+    """Generate speech from text using the Kokoro pipeline, yielding encoded audio as it is produced.
+    
+    `slot` is released once synthesis is over, which may be well before the
+    caller has consumed all of the encoded audio.
+    """
+    stream = None
+    try:
+        encoder = create_encoder(response_format)
         
-        # Combine audio segments if there are multiple
-        if len(audio_segments) > 1:
-            import numpy as np
-            combined_audio = np.concatenate(audio_segments)
-        else:
-            combined_audio = audio_segments[0]
+        # The caller gave up on the request before it got this far
+        if slot is not None and not slot.hand_off():
+            return
         
-        # Get sample rate (should be 24000 for Kokoro)
-        sample_rate = 24000
+        # Synthesis runs on the batcher thread alongside other pending requests;
+        # each segment is encoded here as soon as it arrives
+        stream = speech_batcher.submit(text, voice, lang_code, speed, slot.release if slot else None)
+        has_audio = False
+        for segment in stream:
+            has_audio = True
+            chunk = encoder.encode(to_numpy(segment))
+            if chunk:
+                yield chunk
         
-        # Convert to specified format
-        audio_bytes = convert_audio_format(combined_audio, sample_rate, response_format)
+        if not has_audio:
+            raise ValueError("No audio was generated for the given input")
         
-        return audio_bytes, response_format
+        chunk = encoder.finish()
+        if chunk:
+            yield chunk
         
     except Exception as e:
-        logger.error(f"Error generating speech: {e}")
+        logger.error("Error generating speech: %s", e)
         logger.error(traceback.format_exc())
         raise
+    finally:
+        # Once submitted, the stream reports the end of synthesis itself
+        if stream is None and slot is not None:
+            slot.release()
+
+def float_to_pcm16(audio_array):
+    """Convert float samples in [-1, 1] to clipped int16 PCM.
+    
+    Works through the signal in cache-sized blocks, so the int16 output is the
+    only full-length buffer written instead of a float temporary plus a copy.
+    """
+    samples = np.asarray(audio_array, dtype=np.float32).ravel()
+    pcm = np.empty(samples.size, dtype=np.int16)
+    scratch = np.empty(min(samples.size, PCM_BLOCK_SIZE), dtype=np.float32)
+    
+    for start in range(0, samples.size, PCM_BLOCK_SIZE):
+        block = samples[start:start + PCM_BLOCK_SIZE]
+        buf = scratch[:block.size]
+        np.multiply(block, 32767.0, out=buf)
+        np.rint(buf, out=buf)
+        np.clip(buf, -32768.0, 32767.0, out=buf)
+        pcm[start:start + block.size] = buf
+    
+    return pcm
+
+def wav_stream_header(sample_rate):
+    """Header for a mono 16-bit WAV whose length isn't known yet.
+    
+    The RIFF and data sizes are set to the maximum, which players treat as
+    "read until the end of the stream".
+    """
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 0xFFFFFFFF, b'WAVE', b'fmt ', 16, 1, 1,
+                       sample_rate, sample_rate * 2, 2, 16, b'data', 0xFFFFFFFF)
+
+def finalize_wav(data):
+    """Fill in the real RIFF and data sizes of a complete WAV built with wav_stream_header."""
+    wav = bytearray(data)
+    struct.pack_into('<I', wav, 4, len(wav) - 8)
+    struct.pack_into('<I', wav, 40, len(wav) - 44)
+    return bytes(wav)
+
+class ByteSink:
+    """Write-only, non-seekable file object that collects encoder output until drained."""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+class PCMEncoder:
+    """Raw int16 PCM, emitted segment by segment."""
+    
+    def encode(self, samples):
+        return float_to_pcm16(samples).tobytes()
+    
+    def finish(self):
+        return b""
 
-def convert_audio_format(audio_array, sample_rate, format_name):
-    """Convert audio array to specified format."""
-    import soundfile as sf
-    import io
-    import numpy as np
+class WavStreamEncoder(PCMEncoder):
+    """16-bit WAV that streams: the header goes out with the first segment."""
     
-    # Make sure format is supported
-    if format_name not in SUPPORTED_FORMATS:
-        format_name = "mp3"  # Default to mp3
+    def __init__(self, sample_rate):
+        self._header = wav_stream_header(sample_rate)
     
+    def _take_header(self):
+        header, self._header = self._header, b""
+        return header
+    
+    def encode(self, samples):
+        return self._take_header() + super().encode(samples)
+    
+    def finish(self):
+        return self._take_header()
+
+class AVStreamEncoder:
+    """Incremental PyAV encoder; output is muxed to a non-seekable sink so it can be sent as it is produced."""
+    
+    def __init__(self, format_name, sample_rate):
+        container_format, codec_name = AV_FORMATS[format_name]
+        self.sample_rate = sample_rate
+        self._sink = ByteSink()
+        self._container = av.open(self._sink, mode='w', format=container_format)
+        self._stream = self._container.add_stream(codec_name, rate=sample_rate, layout='mono')
+    
+    def _mux(self, frame):
+        # PyAV resamples and re-frames to whatever the codec expects
+        for packet in self._stream.encode(frame):
+            self._container.mux(packet)
+        return self._sink.drain()
+    
+    def encode(self, samples):
+        samples = np.ascontiguousarray(samples, dtype=np.float32)
+        frame = av.AudioFrame.from_ndarray(samples[None, :], format='flt', layout='mono')
+        frame.sample_rate = self.sample_rate
+        return self._mux(frame)
+    
+    def finish(self):
+        data = self._mux(None)
+        self._container.close()
+        return data + self._sink.drain()
+
+class SoundFileEncoder:
+    """Incremental libsndfile encoder.
+    
+    Each segment is encoded as it arrives, overlapping with synthesis of the
+    next one, but the file is only complete once closed, so all output is
+    returned by finish().
+    """
+    
+    def __init__(self, format_name, sample_rate):
+        sf_format, sf_subtype = SOUNDFILE_FORMATS[format_name]
+        self._buffer = io.BytesIO()
+        self._file = sf.SoundFile(self._buffer, mode='w', samplerate=sample_rate, channels=1,
+                                  format=sf_format, subtype=sf_subtype)
+    
+    def encode(self, samples):
+        self._file.write(float_to_pcm16(samples))
+        return b""
+    
+    def finish(self):
+        self._file.close()
+        return self._buffer.getvalue()
+
+class BufferedEncoder:
+    """Fallback for formats without a streaming encoder: everything is encoded at the end."""
+    
+    def __init__(self, format_name, sample_rate):
+        self.format_name = format_name
+        self.sample_rate = sample_rate
+        self._segments = []
+    
+    def encode(self, samples):
+        self._segments.append(samples)
+        return b""
+    
+    def finish(self):
+        if len(self._segments) > 1:
+            audio = join_segments(self._segments)
+        else:
+            audio = self._segments[0]
+        return encode_with_pydub(audio, self.sample_rate, self.format_name)
+
+def encode_with_pydub(audio_array, sample_rate, format_name):
+    """Last resort when neither PyAV nor libsndfile can encode MP3: hand pydub the raw samples."""
+    audio = pydub.AudioSegment(float_to_pcm16(audio_array).tobytes(), frame_rate=sample_rate, sample_width=2, channels=1)
     audio_io = io.BytesIO()
+    audio.export(audio_io, format=format_name)
+    return audio_io.getvalue()
+
+def build_audio_encoders():
+    """Map each encodable format to its encoder factory, preferring those that stream earliest.
+    
+    Formats no installed backend can encode are left out, so this table alone
+    decides what the server accepts and advertises.
+    """
+    encoders = {"pcm": lambda sample_rate: PCMEncoder(), "wav": WavStreamEncoder}
+    for format_name in AUDIO_FORMATS:
+        if format_name in encoders:
+            continue
+        if format_name in SOUNDFILE_PREFERRED and format_name in SOUNDFILE_FORMATS:
+            encoders[format_name] = functools.partial(SoundFileEncoder, format_name)
+        elif format_name in AV_FORMATS:
+            encoders[format_name] = functools.partial(AVStreamEncoder, format_name)
+        elif format_name in SOUNDFILE_FORMATS:
+            encoders[format_name] = functools.partial(SoundFileEncoder, format_name)
+        elif format_name == "mp3" and pydub is not None:
+            encoders[format_name] = functools.partial(BufferedEncoder, format_name)
+    return encoders
+
+AUDIO_ENCODERS = build_audio_encoders()
+SUPPORTED_FORMATS = frozenset(AUDIO_ENCODERS)
+
+def create_encoder(format_name, sample_rate=SAMPLE_RATE):
+    """Create the encoder for format_name, which must be in SUPPORTED_FORMATS."""
+    return AUDIO_ENCODERS[format_name](sample_rate)
+
+class AudioCache:
+    """Thread-safe in-memory LRU cache of encoded audio with per-entry expiry."""
     
-    # Convert PyTorch tensor to NumPy array if needed
-    if hasattr(audio_array, 'cpu') and hasattr(audio_array, 'numpy'):
-        # It's a PyTorch tensor
-        logger.info("Converting PyTorch tensor to NumPy array")
-        audio_array = audio_array.cpu().numpy()
-    
-    if format_name == "mp3":
-        import scipy.io.wavfile
-        import pydub
-        
-        # Save as WAV first
-        wav_io = io.BytesIO()
-        scipy.io.wavfile.write(wav_io, sample_rate, audio_array)
-        wav_io.seek(0)
-        
-        # Convert to MP3
-        audio = pydub.AudioSegment.from_wav(wav_io)
-        audio.export(audio_io, format="mp3")
-    elif format_name == "opus":
-        # Save as WAV first then convert to opus
-        import scipy.io.wavfile
-        import subprocess
-        
-        # Save as WAV
-        wav_io = io.BytesIO()
-        scipy.io.wavfile.write(wav_io, sample_rate, audio_array)
-        wav_io.seek(0)
-        
-        # Convert to Opus using ffmpeg
-        import tempfile
-        with tempfile.NamedTemporaryFile(suffix='.wav') as temp_wav:
-            temp_wav.write(wav_io.getvalue())
-            temp_wav.flush()
+    def __init__(self, max_size=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(text, voice, lang_code, speed, response_format):
+        """Build a cache key for a synthesis request."""
+        return hashlib.blake2b(f"{voice}|{lang_code}|{speed}|{response_format}|{text.strip()}".encode()).digest()
+    
+    def get(self, key):
+        """Return the cached bytes for key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
             
-            with tempfile.NamedTemporaryFile(suffix='.opus') as temp_opus:
-                subprocess.run(["ffmpeg", "-i", temp_wav.name, "-c:a", "libopus", temp_opus.name, "-y"], 
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                with open(temp_opus.name, 'rb') as f:
-                    audio_io.write(f.read())
-    elif format_name == "pcm":
-        # PCM format is just the raw samples
-        # Convert to int16 PCM format which is common for audio
-        pcm_data = (audio_array * 32767).astype(np.int16)
-        audio_io.write(pcm_data.tobytes())
-    else:
-        # Use soundfile for other formats
-        sf.write(audio_io, audio_array, sample_rate, format=format_name)
-    
-    audio_io.seek(0)
-    return audio_io.getvalue()
+            audio_bytes, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._bytes -= len(audio_bytes)
+                return None
+            
+            self._entries.move_to_end(key)
+            return audio_bytes
+    
+    def set(self, key, audio_bytes, ttl=None):
+        """Store audio bytes under key, evicting the least recently used entries if full.
+        
+        Entries larger than the whole byte budget are not cached.
+        """
+        if len(audio_bytes) > self.max_bytes:
+            return
+        
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[0])
+            
+            self._entries[key] = (audio_bytes, expires_at)
+            self._bytes += len(audio_bytes)
+            while len(self._entries) > self.max_size or self._bytes > self.max_bytes:
+                evicted, _ = self._entries.popitem(last=False)[1]
+                self._bytes -= len(evicted)
 
-@app.route('/v1/audio/speech', methods=['POST'])
-def create_speech():
-    """OpenAI compatible TTS endpoint."""
-    global supported_voices
+audio_cache = AudioCache()
+
+def stream_audio(first_chunk, chunks, format_name, cache_key=None):
+    """Yield encoded audio to the client, caching the full response once it completes."""
+    total = len(first_chunk)
+    sent = [first_chunk] if cache_key is not None else None
+    yield first_chunk
+    for chunk in chunks:
+        total += len(chunk)
+        if sent is not None:
+            sent.append(chunk)
+        yield chunk
     
+    if sent is not None:
+        audio = b"".join(sent)
+        if format_name == "wav":
+            # Cached responses are served whole, so they get a complete header
+            audio = finalize_wav(audio)
+        audio_cache.set(cache_key, audio)
+    
+    logger.info("Successfully generated audio, streamed %d bytes of %s data", total, format_name)
+
+class SpeechRequest(BaseModel):
+    """Body of an OpenAI compatible speech request."""
+    model: str = MODEL_ID
+    input: Optional[str] = None
+    voice: str = DEFAULT_VOICE
+    response_format: str = "mp3"
+    speed: float = 1.0
+
+@app.post('/v1/audio/speech')
+async def create_speech(request: Request):
+    """OpenAI compatible TTS endpoint."""
     try:
-        data = request.get_json(silent=True)
+        # Parse the body with orjson rather than the stdlib json FastAPI uses for body parameters
+        try:
+            data = SpeechRequest.model_validate(orjson.loads(await request.body()))
+        except orjson.JSONDecodeError:
+            logger.error("Invalid JSON payload received")
+            return OrjsonResponse({"error": "Invalid JSON"}, status_code=400)
+        except ValidationError as e:
+            logger.error("Invalid request payload: %s", e)
+            return OrjsonResponse({"error": f"Invalid request: {e}"}, status_code=400)
         
         # Log the incoming request data for debugging
-        logger.info(f"Received request data: {data}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received request data: %s", data.model_dump())
         
-        if data is None:
-            logger.error("Invalid JSON payload received")
-            return jsonify({"error": "Invalid JSON"}), 400
-            
         # Extract parameters
-        model = data.get('model', MODEL_ID)
-        text = data.get('input')
-        voice = data.get('voice', DEFAULT_VOICE)
-        response_format = data.get('response_format', 'mp3')
-        speed = float(data.get('speed', 1.0))
+        model = data.model
+        text = data.input
+        voice = data.voice
+        response_format = data.response_format
+        speed = data.speed
         
         # Log the parameters
-        logger.info(f"Processing request: model={model}, voice={voice}, format={response_format}, speed={speed}")
+        logger.info("Processing request: model=%s, voice=%s, format=%s, speed=%s", model, voice, response_format, speed)
         
         # Extract language code - default to American English 'a'
         lang_code = DEFAULT_LANG_CODE
@@ -242,60 +894,83 @@ def create_speech():
                 lang_code = parts[0]
                 voice = parts[1]
         
-        logger.info(f"Using language code: {lang_code}, voice: {voice}")
+        logger.debug("Using language code: %s, voice: %s", lang_code, voice)
         
         # Validate required parameters
         if not text:
             logger.error("Missing required parameter: input")
-            return jsonify({"error": "Missing required parameter: input"}), 400
-        
-        # Make sure voices are loaded for the language
-        if supported_voices is None or tts_pipeline is None or getattr(tts_pipeline, 'lang_code', None) != lang_code:
-            logger.info(f"Loading pipeline for language {lang_code}")
-            load_pipeline(lang_code)
+            return OrjsonResponse({"error": "Missing required parameter: input"}, status_code=400)
         
-        # Validate voice against known voices
+        # Validate voice against known voices; the pipeline itself is loaded
+        # on demand by the batcher
+        supported_voices = get_supported_voices(lang_code)
         if voice not in supported_voices:
-            logger.error(f"Voice '{voice}' not supported for language '{lang_code}'. Available voices: {supported_voices}")
-            return jsonify({"error": f"Voice '{voice}' not supported for language '{lang_code}'. Supported voices: {supported_voices}"}), 400
+            logger.error("Voice '%s' not supported for language '%s'", voice, lang_code)
+            return OrjsonResponse({"error": f"Voice '{voice}' not supported for language '{lang_code}'. Supported voices: {sorted(supported_voices)}"}, status_code=400)
             
         if response_format not in SUPPORTED_FORMATS:
-            logger.error(f"Format '{response_format}' not supported")
-            return jsonify({"error": f"Format '{response_format}' not supported. Supported formats: {SUPPORTED_FORMATS}"}), 400
+            logger.error("Format '%s' not supported", response_format)
+            return OrjsonResponse({"error": f"Format '{response_format}' not supported. Supported formats: {sorted(SUPPORTED_FORMATS)}"}, status_code=400)
         
-        logger.info(f"Generating speech for text: '{text[:50]}{'...' if len(text) > 50 else ''}'")
-            
-        # Generate speech
-        audio_bytes, format_name = generate_speech(
+        mimetype = f"audio/{response_format}"
+        if response_format == "wav":
+            mimetype = "audio/wav"
+        elif response_format == "pcm":
+            mimetype = "audio/pcm"  # Set appropriate MIME type
+        headers = {"Content-Disposition": f'attachment; filename="speech.{response_format}"'}
+        
+        # Repeated phrases are served from the cache; very long inputs bypass it to bound memory
+        cache_key = None
+        if len(text) <= CACHE_MAX_TEXT_LENGTH:
+            cache_key = AudioCache.make_key(text, voice, lang_code, speed, response_format)
+            audio_bytes = audio_cache.get(cache_key)
+            if audio_bytes is not None:
+                logger.info("Serving %d bytes of %s data from cache", len(audio_bytes), response_format)
+                return Response(audio_bytes, media_type=mimetype, headers=headers)
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Generating speech for text: '%s%s'", text[:50], '...' if len(text) > 50 else '')
+        
+        # Bound the number of requests being synthesized; beyond that, callers
+        # wait up to QUEUE_TIMEOUT_SECONDS for a slot and are then turned away
+        try:
+            await asyncio.wait_for(request_slots.acquire(), QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("Rejecting request: no synthesis slot free after %ss", QUEUE_TIMEOUT_SECONDS)
+            return OrjsonResponse({"error": "Server is busy, please retry later"}, status_code=503, headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+        slot = RequestSlot(asyncio.get_running_loop())
+        
+        chunks = generate_speech(
             text=text,
             voice=voice,
             lang_code=lang_code,
             response_format=response_format,
-            speed=speed
+            speed=speed,
+            slot=slot
         )
         
-        # Return audio file
-        mimetype = f"audio/{format_name}"
-        if format_name == "wav":
-            mimetype = "audio/wav"
-        elif format_name == "pcm":
-            mimetype = "audio/pcm"  # Set appropriate MIME type
+        # Wait for the first chunk before answering so synthesis errors still
+        # produce an error response; the rest is streamed as it is encoded
+        try:
+            first_chunk = await asyncio.to_thread(next, chunks, b"")
+        except BaseException:
+            # Frees the slot if cancellation came before the request reached
+            # the batcher; otherwise it is held until synthesis ends
+            slot.abandon()
+            raise
         
-        logger.info(f"Successfully generated audio, returning {len(audio_bytes)} bytes of {format_name} data")
-            
-        return send_file(
-            io.BytesIO(audio_bytes),
-            mimetype=mimetype,
-            as_attachment=True,
-            download_name=f"speech.{format_name}"
+        return StreamingResponse(
+            stream_audio(first_chunk, chunks, response_format, cache_key),
+            media_type=mimetype,
+            headers=headers
         )
         
     except Exception as e:
-        logger.error(f"Error in create_speech endpoint: {str(e)}")
+        logger.error("Error in create_speech endpoint: %s", e)
         logger.error(traceback.format_exc())
-        return jsonify({"error": str(e)}), 500
+        return OrjsonResponse({"error": str(e)}, status_code=500)
 
-@app.route('/v1/models', methods=['GET'])
+@app.get('/v1/models')
 def list_models():
     """OpenAI compatible models listing endpoint."""
     models = [
@@ -310,42 +985,37 @@ def list_models():
         }
     ]
     
-    return jsonify({"object": "list", "data": models})
+    return {"object": "list", "data": models}
 
-@app.route('/v1/languages', methods=['GET'])
+@app.get('/v1/languages')
 def list_languages():
     """List available languages for Kokoro."""
-    return jsonify({
+    return {
         "object": "list",
         "data": [
             {"code": code, "name": name} for code, name in supported_langs.items()
         ]
-    })
+    }
 
-@app.route('/health', methods=['GET'])
+@app.get('/health')
 def health_check():
     """Health check endpoint."""
-    global supported_voices
-    
-    # Make sure voices are loaded
-    if supported_voices is None:
-        supported_voices = get_supported_voices()
-    
-    return jsonify({
+    return {
         "status": "ok", 
         "model": MODEL_ID,
         "supported_languages": supported_langs,
-        "supported_voices": supported_voices,
-        "supported_formats": SUPPORTED_FORMATS
-    })
+        "supported_voices": sorted(get_supported_voices()),
+        "supported_formats": sorted(SUPPORTED_FORMATS)
+    }
 
 if __name__ == "__main__":
     # Pre-load the pipeline
     try:
-        load_pipeline()
+        get_pipeline()
     except Exception as e:
-        logger.error(f"Failed to load TTS pipeline: {e}")
+        logger.error("Failed to load TTS pipeline: %s", e)
     
-    # Run the server
-    logger.info(f"Starting server on {HOST}:{PORT}")
-    app.run(host=HOST, port=PORT, debug=True)
\ No newline at end of file
+    # Run the server. A single process owns the GPU; concurrency comes from
+    # the event loop and the speech batcher rather than extra workers.
+    logger.info("Starting server on %s:%s", HOST, PORT)
+    uvicorn.run(app, host=HOST, port=PORT, loop="auto")